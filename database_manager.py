@@ -1,8 +1,29 @@
+import numpy as np
 import psycopg2
+from psycopg2 import pool
 from psycopg2.extras import execute_values
 import pandas as pd
 import Config as cf
 
+# Shared across all DatabaseManager instances so scheduled pipeline runs
+# reuse connections instead of paying a TCP+auth handshake per batch.
+_POOL = None
+
+def _get_pool():
+    """Lazily creates the module-wide PostgreSQL connection pool."""
+    global _POOL
+    if _POOL is None:
+        db_config = cf.DB_CONFIG_POSTGRES
+        _POOL = pool.ThreadedConnectionPool(
+            minconn=1, maxconn=8,
+            host=db_config['host'],
+            database=db_config['database'],
+            user=db_config['user'],
+            password=db_config['password'],
+            port=db_config.get('port', 5432)
+        )
+    return _POOL
+
 class DatabaseManager:
     """Handles all interactions with the PostgreSQL database."""
     def __init__(self):
@@ -14,24 +35,21 @@ class DatabaseManager:
     def connect(self):
         if self.cnxn: return
         try:
-            self.cnxn = psycopg2.connect(
-                host=self.db_config['host'],
-                database=self.db_config['database'],
-                user=self.db_config['user'],
-                password=self.db_config['password'],
-                port=self.db_config.get('port', 5432)
-            )
+            self.cnxn = _get_pool().getconn()
             self.cnxn.autocommit = True
             self.cursor = self.cnxn.cursor()
-            print("Successfully connected to PostgreSQL (autocommit mode)!")
+            print("Successfully checked out a PostgreSQL connection (autocommit mode)!")
         except psycopg2.OperationalError as ex:
             print(f"PostgreSQL connection failed: {ex}")
             raise
 
     def disconnect(self):
         if self.cursor: self.cursor.close()
-        if self.cnxn: self.cnxn.close()
-        print("PostgreSQL connection closed.")
+        if self.cnxn:
+            _get_pool().putconn(self.cnxn)
+            self.cnxn = None
+            self.cursor = None
+        print("PostgreSQL connection returned to pool.")
 
     def _setup_database_schema(self):
         """Creates tables and constraints using PostgreSQL snake_case naming convention."""
@@ -86,55 +104,86 @@ class DatabaseManager:
             brands_df.columns = [col.lower() for col in brands_df.columns]
             history_df.columns = [col.lower() for col in history_df.columns]
             
-            # --- Step 2: Process brand_details Table ---
+            # --- Step 2: Upsert brand_details and get brand IDs back server-side ---
             print("\n--- Processing brand_details ---")
-            
-            # Sử dụng tên cột chữ thường, không dấu ngoặc kép
-            existing_brands_df = pd.read_sql("SELECT brand_id, brand_name FROM brand_details", self.cnxn)
-            
-            merged_brands = pd.merge(brands_df, existing_brands_df, on='brand_name', how='left', indicator=True)
-            new_brands_to_insert = merged_brands[merged_brands['_merge'] == 'left_only']
-            
-            if not new_brands_to_insert.empty:
+
+            brand_id_map = {}
+            if not brands_df.empty:
                 # Đảm bảo các cột khớp với bảng CSDL
                 db_brand_columns = ['brand_name', 'brand_link', 'is_official', 'brand_rating', 'num_rating', 'joined_date', 'last_scraped_date']
-                columns_to_insert = [col for col in db_brand_columns if col in new_brands_to_insert.columns]
-                new_brands_final = new_brands_to_insert[columns_to_insert]
-                
-                print(f"Found {len(new_brands_final)} new brands to insert.")
-                
-                data_tuples = [tuple(row) for row in new_brands_final.itertuples(index=False)]
+                columns_to_insert = [col for col in db_brand_columns if col in brands_df.columns]
+                brands_final = brands_df[columns_to_insert].drop_duplicates(subset=['brand_name'])
+
+                # Thu hẹp dtype trước khi tạo tuple: giảm một nửa bộ nhớ so với int64/float64
+                brand_dtypes = {'is_official': 'bool', 'brand_rating': 'float32', 'num_rating': 'int32'}
+                brands_final = brands_final.astype({col: dt for col, dt in brand_dtypes.items()
+                                                    if col in brands_final.columns})
+
+                data_tuples = list(brands_final.itertuples(index=False, name=None))
                 cols_sql = ', '.join(columns_to_insert)
-                insert_query = f"INSERT INTO brand_details ({cols_sql}) VALUES %s"
-                
-                execute_values(self.cursor, insert_query, data_tuples)
-                print("New brands inserted.")
+                # DO UPDATE (not DO NOTHING) so RETURNING also fires for brands
+                # that already exist, yielding every brand_id in a single pass.
+                upsert_query = f"""
+                    INSERT INTO brand_details ({cols_sql}) VALUES %s
+                    ON CONFLICT (brand_name) DO UPDATE SET last_scraped_date = EXCLUDED.last_scraped_date
+                    RETURNING brand_id, brand_name
+                """
+                template = '(' + ', '.join(['%s'] * len(columns_to_insert)) + ')'
+
+                returned_rows = execute_values(self.cursor, upsert_query, data_tuples,
+                                               template=template, page_size=1000, fetch=True)
+                brand_id_map = {brand_name: brand_id for brand_id, brand_name in returned_rows}
+                print(f"Upserted {len(brand_id_map)} brands.")
             else:
-                print("No new brands to insert.")
+                print("No brand data to process.")
 
             # --- Step 3: Prepare tiki_products_history Data ---
             print("\n--- Preparing tiki_products_history ---")
-            all_brands_with_id_df = pd.read_sql("SELECT brand_id, brand_name FROM brand_details", self.cnxn)
-            
-            # Join trên cột 'brand_name' (đã được chuẩn hóa thành chữ thường)
-            history_with_brand_id = pd.merge(history_df, all_brands_with_id_df, on='brand_name', how='left')
-            
-            # Lọc trùng lặp và loại bỏ các dòng không join được
-            history_with_brand_id.drop_duplicates(subset=['name', 'brand_id', 'scraped_date'], keep='first', inplace=True)
+
+            # Gán brand_id bằng lookup trực tiếp, không cần pd.merge
+            # (nullable Int32 giữ kiểu int cho các dòng map được thay vì float64)
+            history_with_brand_id = history_df.copy()
+            history_with_brand_id['brand_id'] = history_with_brand_id['brand_name'].map(brand_id_map).astype('Int32')
+
+            # Lọc trùng lặp trên (name, brand_id, scraped_date) bằng khóa số đã
+            # factorize thay vì drop_duplicates (tránh so sánh chuỗi khi sort).
+            # Mã -1 (giá trị NA) được dịch lên 0 để khóa tổng hợp luôn không âm.
+            name_codes, _ = pd.factorize(history_with_brand_id['name'])
+            brand_codes, _ = pd.factorize(history_with_brand_id['brand_id'])
+            date_codes, _ = pd.factorize(history_with_brand_id['scraped_date'])
+            composite_keys = (
+                ((name_codes.astype('int64') + 1) * (brand_codes.max() + 2) + (brand_codes + 1))
+                * (date_codes.max() + 2) + (date_codes + 1)
+            )
+            _, first_seen_idx = np.unique(composite_keys, return_index=True)
+            history_with_brand_id = history_with_brand_id.iloc[np.sort(first_seen_idx)]
+
+            # Loại bỏ các dòng không map được brand_id; giải phóng frame trung gian
             final_fact_data = history_with_brand_id.dropna(subset=['brand_id'])
-            final_fact_data['brand_id'] = final_fact_data['brand_id'].astype(int)
+            del history_with_brand_id
 
-            # Xác định các cột cuối cùng để insert
+            # Xác định các cột cuối cùng để insert, thu hẹp dtype trước khi serialize
             fact_columns = ['name', 'price', 'sold_count', 'link', 'rating', 'scraped_date', 'brand_id']
-            final_fact_data_to_insert = final_fact_data[fact_columns]
+            final_fact_data_to_insert = final_fact_data[fact_columns].astype(
+                {'price': 'int32', 'sold_count': 'int32', 'rating': 'float32', 'brand_id': 'int32'})
 
             if not final_fact_data_to_insert.empty:
-                data_tuples = [tuple(row) for row in final_fact_data_to_insert.itertuples(index=False)]
                 cols_sql = ', '.join(fact_columns)
-                insert_query = f"INSERT INTO tiki_products_history ({cols_sql}) VALUES %s ON CONFLICT (name, brand_id, scraped_date) DO NOTHING"
-                
-                print(f"Inserting {len(data_tuples)} records into tiki_products_history...")
-                execute_values(self.cursor, insert_query, data_tuples)
+                print(f"Inserting {len(final_fact_data_to_insert)} records into tiki_products_history...")
+
+                # One pre-mogrified multi-row INSERT per chunk: no page
+                # splitting, and the ON CONFLICT dedup stays inline instead of
+                # needing a staging table. to_numpy().tolist() boxes the rows
+                # to plain Python values psycopg2 can adapt directly.
+                insert_prefix = f"INSERT INTO tiki_products_history ({cols_sql}) VALUES ".encode()
+                insert_suffix = b" ON CONFLICT (name, brand_id, scraped_date) DO NOTHING"
+                data_rows = final_fact_data_to_insert.to_numpy(copy=False).tolist()
+
+                chunk_size = 5000  # bounds single-statement size
+                for start in range(0, len(data_rows), chunk_size):
+                    chunk = data_rows[start:start + chunk_size]
+                    args = b",".join(self.cursor.mogrify("(%s,%s,%s,%s,%s,%s,%s)", row) for row in chunk)
+                    self.cursor.execute(insert_prefix + args + insert_suffix)
                 print("Product history data inserted successfully.")
             else:
                 print("No valid product history data to insert.")
@@ -5,79 +5,205 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse, parse_qsl
+import aiohttp
+import asyncio
 import requests
-import time
 import os
 import re
-import json
+import orjson
+import numpy as np
 import pandas as pd
 from datetime import datetime, date, timedelta
 
+# Compiled once at import; reused for every listing item.
+_DIGITS = re.compile(r'\D')
+_WIDTH = re.compile(r'width:\s*(\d+)%')
+
+# Sent with every outbound HTTP request (set once at session level).
+_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
+}
+
 class TikiScraper:
     """
     A web scraper designed to collect product and brand data from Tiki.vn.
-    It uses a hybrid approach: Selenium for navigating listing pages and
-    direct requests/API calls for fetching detailed information to optimize performance.
+    Listing pages are fetched from Tiki's listings API over plain HTTPS;
+    Selenium is started lazily and only as a fallback when the API yields
+    nothing. Detailed information comes from direct requests/API calls.
     """
 
-    def __init__(self): 
+    def __init__(self):
         """Initializes the scraper for a Docker environment."""
-        
+
         self.options = webdriver.ChromeOptions()
         self.options.add_argument("start-maximized")
+        # Headless without images: the scraper only reads DOM text, so
+        # rendering and image downloads are pure waste.
+        self.options.add_argument('--headless=new')
+        self.options.add_argument('--disable-gpu')
+        self.options.add_argument('--blink-settings=imagesEnabled=false')
         self.options.add_experimental_option("excludeSwitches", ["enable-automation"])
         self.options.add_experimental_option('useAutomationExtension', False)
-        
-        # Kết nối đến Selenium Grid đang chạy trong container 'selenium'
-        
-        self.driver = Remote(
-            command_executor='http://selenium:4444/wd/hub',
-            options=self.options
-        )
+        self.options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.default_content_setting_values.notifications': 2
+        })
+
+        # Selenium is only needed when the listings API fails, so the
+        # browser is not started until _ensure_driver is called.
+        self.driver = None
+        self.wait = None
+
+        # Pooled session with retries for the synchronous listing fetches.
+        self.session = requests.Session()
+        self.session.headers.update(_HEADERS)
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
         self.today = date.today()
-        
-        self.wait = WebDriverWait(self.driver, 20)
+        # seller_id -> brand API payload; many products share a seller, so
+        # each brand is fetched at most once (also across scrape() calls).
+        self._brand_cache = {}
         print("TikiScraper initialized for Docker environment.")
 
+    def _ensure_driver(self):
+        """Starts the remote Selenium driver on first use (fallback path only)."""
+        if self.driver is None:
+            # Kết nối đến Selenium Grid đang chạy trong container 'selenium'
+            self.driver = Remote(
+                command_executor='http://selenium:4444/wd/hub',
+                options=self.options
+            )
+            self.wait = WebDriverWait(self.driver, 20)
+            print("Selenium driver started (listing API fallback).")
+
     def _get_page_source(self, url):
         """Navigates to a URL using Selenium, scrolls to load all content, and returns the page source."""
+        self._ensure_driver()
         print(f"Navigating to: {url}")
         self.driver.get(url)
         
         # Critical Step: Wait for product items to be present in the DOM
         self.wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "a.product-item")))
         
-        # Scroll down to trigger lazy-loading of all elements
+        # Scroll down to trigger lazy-loading and poll until the number of
+        # product items stops growing, instead of fixed sleeps.
         print("Page loaded. Scrolling to load all content...")
-        self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight / 2);")
-        time.sleep(1)
-        self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(2)
-        
+        prev_count = -1
+
+        def _items_stable(driver):
+            nonlocal prev_count
+            current = len(driver.find_elements(By.CSS_SELECTOR, "a.product-item"))
+            if current == prev_count:
+                return True
+            prev_count = current
+            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+            return False
+
+        WebDriverWait(self.driver, 20, poll_frequency=0.5).until(_items_stable)
+
         return self.driver.page_source
 
-    def _get_data_and_ids_from_next_data(self, product_url):
+    def _get_listing_via_api(self, base_url, page_num):
+        """
+        Fetches one listing page straight from Tiki's listings API — no
+        browser, no rendering, no lazy-load waits. Returns a list of
+        (name, price, link, rating) tuples, or None when the API yields
+        nothing so the caller can fall back to Selenium.
+        """
+        params = dict(parse_qsl(urlparse(base_url).query))  # carries q=<keyword> over
+        params.setdefault('limit', 40)
+        params['page'] = page_num
+
+        try:
+            response = self.session.get('https://tiki.vn/api/personalish/v1/blocks/listings',
+                                        params=params, timeout=10)
+            response.raise_for_status()
+            items = orjson.loads(response.content).get('data', [])
+        except Exception as e:
+            print(f"  -> Listings API failed for page {page_num}: {e}")
+            return None
+
+        if not items:
+            return None
+
+        rows = []
+        for product in items:
+            url_path = product.get('url_path')
+            if not url_path:
+                continue
+            rows.append((
+                product.get('name', 'N/A'),
+                int(product.get('price') or 0),
+                'https://tiki.vn/' + url_path.lstrip('/'),
+                round(float(product.get('rating_average') or 0.0), 1),
+            ))
+        return rows or None
+
+    def _parse_listing_items(self, page_source):
+        """Parses a rendered listing page into (name, price, link, rating) rows (Selenium fallback)."""
+        soup = BeautifulSoup(page_source, 'lxml')
+        product_items = soup.find_all('a', class_='product-item')
+
+        names, price_strs, links, rating_styles = [], [], [], []
+        for item in product_items:
+            try:
+                # Each selector runs once; reuse the result instead of
+                # searching again for the read.
+                name_tag = item.find('h3', class_='sc-68e86366-8 dDeapS')
+                name = name_tag.get_text(strip=True) if name_tag else "N/A"
+                price_tag = item.find('div', class_='price-discount__price')
+                price_str = price_tag.get_text(strip=True) if price_tag else "0"
+                link = 'https://tiki.vn' + item['href']
+
+                # Keep the raw style string; the rating is extracted in
+                # bulk after the loop instead of per item.
+                width_div = item.select_one('div.sc-68e86366-6.lbZNwv > div[style]')
+                rating_style = width_div['style'] if width_div else ''
+
+                names.append(name)
+                price_strs.append(price_str)
+                rating_styles.append(rating_style)
+                links.append(link)
+            except Exception:
+                continue
+
+        # Vectorized post-processing of the raw listing fields
+        prices = pd.Series(price_strs, dtype='object').str.replace(_DIGITS, '', regex=True).replace('', '0').astype('int32')
+        widths = pd.Series(rating_styles, dtype='object').str.extract(_WIDTH, expand=False)
+        ratings = (widths.fillna(0).astype('float32') * 0.05).round(1)
+
+        return list(zip(names, prices.tolist(), links, ratings.tolist()))
+
+    async def _get_data_and_ids_from_next_data(self, session, product_url):
         """
         Fetches the __NEXT_DATA__ JSON from a product detail page to extract
         the full product data block and essential IDs (product_id, spid, seller_id).
-        This method uses `requests` for high performance.
+        This coroutine only awaits the network I/O; parsing stays synchronous.
         """
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
-            }
-            response = requests.get(product_url, headers=headers, timeout=10)
-            response.raise_for_status()
-    
-            soup = BeautifulSoup(response.content, 'html.parser')
-            script_tag = soup.find('script', {'id': '__NEXT_DATA__'})
-    
+            async with session.get(product_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                response.raise_for_status()
+                content = await response.read()
+
+            # selectolax is much faster than BeautifulSoup for pulling a
+            # single tag out of a large page.
+            tree = HTMLParser(content)
+            script_tag = tree.css_first('script#__NEXT_DATA__')
+
             if script_tag:
-                json_data = json.loads(script_tag.string)
-                
-                # Recursively find the data blocks we need
-                sold_data = self.find_parent_recursively(json_data, 'quantity_sold')
-                product_data = self.find_parent_recursively(json_data, 'sellerId')
+                json_data = orjson.loads(script_tag.text())
+
+                # Find both data blocks we need in a single walk
+                parents = self._find_parents(json_data, frozenset({'quantity_sold', 'sellerId'}))
+                sold_data = parents.get('quantity_sold')
+                product_data = parents.get('sellerId')
 
                 if not product_data:
                     print(f"  -> Could not recursively find a product data block in __NEXT_DATA__ for {product_url}")
@@ -106,105 +232,138 @@ class TikiScraper:
             print(f"  -> An unexpected error occurred while processing {product_url}: {e}")
             return None, None
 
-    def _get_brand_details_via_api(self, ids):
+    async def _get_brand_details_via_api(self, session, ids):
         """Fetches detailed brand (seller) data using Tiki's internal API."""
         if not all(ids.get(k) for k in ['seller_id', 'product_id', 'spid']):
             return None
-        
+
         api_url = f"https://api.tiki.vn/product-detail/v2/widgets/seller?seller_id={ids['seller_id']}&mpid={ids['product_id']}&spid={ids['spid']}&trackity_id=0c339b08-95f0-a9ef-8705-0feb40c4d971&platform=desktop&version=3"
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'}
-        
+
         try:
-            response = requests.get(api_url, headers=headers, timeout=5)
-            response.raise_for_status()
-            return response.json()
+            async with session.get(api_url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                response.raise_for_status()
+                return orjson.loads(await response.read())
         except Exception as e:
             print(f"  -> Brand API call failed for seller {ids['seller_id']}. Error: {e}")
             return None
 
-    def find_parent_recursively(self, data_blob, target_key):
-        """Recursively searches for a target_key and returns the PARENT DICTIONARY that contains it."""
-        if isinstance(data_blob, dict):
-            if target_key in data_blob:
-                return data_blob
-            for value in data_blob.values():
-                found = self.find_parent_recursively(value, target_key)
-                if found is not None:
-                    return found
-        elif isinstance(data_blob, list):
-            for item in data_blob:
-                found = self.find_parent_recursively(item, target_key)
-                if found is not None:
-                    return found
-        return None
+    async def _enrich_all(self, product_links):
+        """
+        Fetches all product detail pages, then all brand API endpoints,
+        concurrently over a single pooled session. Returns a list of
+        (product_data_json, ids, brand_json) tuples aligned with product_links.
+        """
+        semaphore = asyncio.Semaphore(32)
+        connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+
+        async with aiohttp.ClientSession(connector=connector, headers=_HEADERS) as session:
+            async def fetch_details(link):
+                async with semaphore:
+                    return await self._get_data_and_ids_from_next_data(session, link)
+
+            detail_results = await asyncio.gather(*(fetch_details(link) for link in product_links))
+
+            # Deduplicate sellers before hitting the brand API; anything
+            # already in the cache is skipped entirely.
+            ids_by_seller = {}
+            for _, ids in detail_results:
+                if ids and ids.get('seller_id'):
+                    seller_id = ids['seller_id']
+                    if seller_id not in self._brand_cache and seller_id not in ids_by_seller:
+                        ids_by_seller[seller_id] = ids
+
+            async def fetch_brand(ids):
+                async with semaphore:
+                    return await self._get_brand_details_via_api(session, ids)
+
+            fetched = await asyncio.gather(*(fetch_brand(ids) for ids in ids_by_seller.values()))
+            for seller_id, brand_json in zip(ids_by_seller, fetched):
+                if brand_json is not None:
+                    self._brand_cache[seller_id] = brand_json
+
+        return [
+            (data, ids, self._brand_cache.get(ids['seller_id']) if ids and ids.get('seller_id') else None)
+            for data, ids in detail_results
+        ]
+
+    def _find_parents(self, data_blob, target_keys):
+        """
+        Walks a nested JSON blob with an explicit stack and returns a dict
+        mapping each target_key to the PARENT DICTIONARY that contains it.
+        One depth-first pass covers all keys at once and stops as soon as
+        every key has been found.
+        """
+        found = {}
+        stack = [data_blob]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                for key in target_keys:
+                    if key not in found and key in node:
+                        found[key] = node
+                if len(found) == len(target_keys):
+                    break
+                # Push children reversed so they are visited in natural order
+                stack.extend(reversed(node.values()))
+            elif isinstance(node, list):
+                stack.extend(reversed(node))
+        return found
 
     def scrape(self, base_url, num_pages=1):
         """Orchestrates the entire scraping process."""
         all_product_links = []
-        scraped_data_from_list_page = []
+        names, prices, ratings = [], [], []
 
         try:
             # --- PHASE 1: Scrape basic product info and all links from listing pages ---
             for page_num in range(1, num_pages + 1):
-                url_with_page = f"{base_url}&page={page_num}"
                 print(f"\n--- Scraping Page {page_num} for basic info and links ---")
-                
-                page_source = self._get_page_source(url_with_page)
-                soup = BeautifulSoup(page_source, 'html.parser')
-                product_items = soup.find_all('a', class_='product-item')
-                
-                for item in product_items:
-                    try:
-                        name = item.find('h3', class_='sc-68e86366-8 dDeapS').text.strip() if item.find('h3', class_='sc-68e86366-8 dDeapS') else "N/A"
-                        price_str = item.find('div', class_='price-discount__price').text.strip() if item.find('div', class_='price-discount__price') else "0"
-                        price = int(re.sub(r'\D', '', price_str))
-                        link = 'https://tiki.vn' + item['href']
-                        
-                        rating_stars = 0.0
-                        parent_rating_div = item.find('div', class_='sc-68e86366-6 lbZNwv') 
-                        if parent_rating_div:
-                            width_div = parent_rating_div.find('div', style=True)
-                            if width_div:
-                                match = re.search(r'width:\s*(\d+)%', width_div['style'])
-                                if match:
-                                    rating_stars = round((int(match.group(1)) / 100) * 5, 1)
-                        
-                        scraped_data_from_list_page.append({
-                            'name': name,
-                            'price': price,
-                            'link': link,
-                            'rating': rating_stars,
-                            'scraped_date': self.today.strftime('%Y-%m-%d')
-                        })
-                        all_product_links.append(link)
-                    except Exception:
-                        continue
+
+                rows = self._get_listing_via_api(base_url, page_num)
+                if rows is None:
+                    # Fall back to a rendered page only when the API gives nothing.
+                    url_with_page = f"{base_url}&page={page_num}"
+                    page_source = self._get_page_source(url_with_page)
+                    rows = self._parse_listing_items(page_source)
+
+                for name, price, link, rating in rows:
+                    names.append(name)
+                    prices.append(price)
+                    ratings.append(rating)
+                    all_product_links.append(link)
         finally:
-            self.driver.quit()
-            print("\nSelenium driver closed. Starting API/Requests phase.")
-    
+            if self.driver is not None:
+                self.driver.quit()
+                self.driver = None
+            print("\nListing phase finished. Starting API/Requests phase.")
+
+        # One Timestamp for the whole batch; broadcasting it into the frame
+        # gives a real datetime64 column psycopg2/COPY can pass natively.
+        scraped_date = pd.Timestamp(self.today)
+
         # --- Data enrichment phase ---
-        final_products_history = []
+        # Parallel columnar lists instead of per-product dicts: keep_mask marks
+        # which listing rows survive enrichment, brand_names/sold_counts are
+        # appended only for those rows.
+        keep_mask = np.zeros(len(all_product_links), dtype=bool)
+        brand_names, sold_counts = [], []
         final_brands_details = {} # Use dict with seller_id as key to avoid duplicates
 
-        print(f"\n--- Fetching detailed data for {len(all_product_links)} products ---")
-        for i, link in enumerate(all_product_links):
-            print(f"Processing product {i+1}/{len(all_product_links)}: {link[:70]}...")
-            
-            product_data_json, ids = self._get_data_and_ids_from_next_data(link)
+        print(f"\n--- Fetching detailed data for {len(all_product_links)} products concurrently ---")
+        enriched_results = asyncio.run(self._enrich_all(all_product_links))
+
+        for i, (product_data_json, ids, brand_json) in enumerate(enriched_results):
             if not (product_data_json and ids):
                 print("  -> Could not get data/IDs. Skipping product.")
                 continue
 
             seller_id = ids.get('seller_id')
             if seller_id:
-                brand_json = self._get_brand_details_via_api(ids)
                 # Enrich the initial scraped data with new info
-                current_product_record = scraped_data_from_list_page[i]
-                current_product_record['brand_name'] = brand_json['data']['seller'].get('name', 'N/A') if brand_json else 'N/A'
-                current_product_record['sold_count'] = ids['quantity_sold']
-                final_products_history.append(current_product_record)
-                
+                keep_mask[i] = True
+                brand_names.append(brand_json['data']['seller'].get('name', 'N/A') if brand_json else 'N/A')
+                sold_counts.append(ids['quantity_sold'])
+
                 # Process and store brand details if it's a new brand
                 if brand_json and 'data' in brand_json and 'seller' in brand_json['data']:
                     if seller_id not in final_brands_details:
@@ -225,14 +384,25 @@ class TikiScraper:
                             'is_official': bool(brand_json.get('IsOfficial', False)),
                             'brand_rating': brand_rating,
                             'num_rating': num_rating,
-                            'joined_date': (self.today - join_days).strftime('%Y-%m-%d'),
-                            'last_scraped_date': self.today.strftime('%Y-%m-%d')
+                            'joined_date': self.today - join_days,
+                            'last_scraped_date': self.today
                         }
         
         # --- PHASE 4: Prepare and return DataFrames ---
         brands_df = pd.DataFrame(list(final_brands_details.values()))
-        history_df = pd.DataFrame(final_products_history)
-        
+        if brand_names:
+            history_df = pd.DataFrame({
+                'name': np.asarray(names, dtype=object)[keep_mask],
+                'price': np.asarray(prices, dtype='int32')[keep_mask],
+                'link': np.asarray(all_product_links, dtype=object)[keep_mask],
+                'rating': np.asarray(ratings, dtype='float32')[keep_mask],
+                'scraped_date': scraped_date,
+                'brand_name': brand_names,
+                'sold_count': np.asarray(sold_counts, dtype='int32'),
+            })
+        else:
+            history_df = pd.DataFrame()
+
         # brands_df.columns = [col.replace(' ', '_').replace('Is', 'is_').replace('Num', 'num_').replace('Link', '_link').replace('Name', '_name').replace('Date', '_date').replace('Rating','_rating') for col in brands_df.columns]
         # history_df.columns = [col.replace(' ', '_').replace('Is', 'is_').replace('Num', 'num_').replace('Link', '_link').replace('Name', '_name').replace('Date', '_date').replace('Rating','_rating') for col in history_df.columns]
         return brands_df, history_df